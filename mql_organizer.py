@@ -2,12 +2,20 @@
 2020, nicholishen
 
 Requires:
-    Python >= 3.6
-    pandas
-    openpyxl
+    Python >= 3.7
+    xlsxwriter
     chardet
 
-    pip install -U pandas ujson openpyxl chardet
+    pip install -U ujson xlsxwriter chardet
+
+    Optional (much faster checksums, used automatically when installed):
+    pip install -U blake3
+
+    Optional (much faster encoding detection, used instead of chardet when installed):
+    pip install -U cchardet
+
+    Optional (much faster JSON report, used instead of ujson when installed):
+    pip install -U orjson
 
 
 What it is:
@@ -30,6 +38,7 @@ Reporting:
 
     time_completed: datetime that the script was run
     total_files: The total number of files in the directory
+    checksum_algo: The hash algorithm used for the checksums (blake3 if installed, otherwise blake2b)
     search_path: The path of the most recent search
     save_path: The path where the organized files were copied to
     extensions: An array of extensions that were searched
@@ -52,128 +61,275 @@ Reporting:
     ]
 
     To get the optional Excel report the following dependencies must be installed:
-    pip install -U pandas openpyxl
+    pip install -U xlsxwriter
 
 Note: Files are only copied. Original files are not moved or deleted. On one hand it is safe to run this script,
-but on the other, copied files will consume more disk space.
+but on the other, copied files will consume more disk space. To avoid that, files can be hard-linked instead of copied
+when the save directory is on the same drive (falls back to copying otherwise). A hard-linked file is the same file as
+the original, so editing one also changes the other.
 """
+import codecs
 import contextlib
 import datetime as dt
 import hashlib
 import itertools
+import mmap
+import multiprocessing
+import os
 import re
 import shutil
+import sys
 import typing as typ
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 
-import chardet
-import pandas as pd
-import openpyxl
-
 try:
     import ujson as json  # ujson is much faster
 except ImportError:
     import json
 
+try:
+    import orjson  # faster still, and emits bytes that can go straight to the file
+except ImportError:
+    orjson = None
+
+try:
+    from cchardet import detect as detect_encoding  # C++ bindings, much faster than chardet
+except ImportError:
+    try:
+        from charset_normalizer import detect as detect_encoding
+    except ImportError:
+        from chardet import detect as detect_encoding
+
 MQL_SRC_FILES = {'.mqh', '.mq4', '.mq5'}
 BUFFER_SIZE = 2 ** 16
-HASH_ALGO = 'blake2b'
-HASH_CLASS = getattr(hashlib, HASH_ALGO)
-RE_PATTERNS = {
-    'copyright': re.compile(r'^#property\scopyright\s*"(.*?)"\s*$', re.MULTILINE),
-    'version'  : re.compile(r'^#property\sversion\s*"(.*?)"\s*$', re.MULTILINE),
-    'link'     : re.compile(r'^#property\slink\s*"(.*?)"\s*$', re.MULTILINE),
-}
+SNIFF_SIZE = 2 ** 15  # bytes read from the top of a source file to detect its encoding and #property lines
+MMAP_MAX_SIZE = sys.maxsize  # larger files can't be mapped in one piece (32-bit builds)
+try:
+    from blake3 import blake3 as HASH_CLASS  # SIMD accelerated and multithreaded per file
+    HASH_ALGO = 'blake3'
+except ImportError:
+    HASH_ALGO = 'blake2b'
+    HASH_CLASS = getattr(hashlib, HASH_ALGO)
+SIZE_KEY_PREFIX = 'size:'
+Checksum = typ.Union[bytes, str]  # digest bytes, or a size_key() placeholder for files that weren't hashed
+HASH_WORKERS = os.cpu_count() or 1  # both hash backends release the GIL while hashing, so threads are enough
+REPORT_WORKERS = os.cpu_count() or 1
+REPORT_POOL_MIN_FILES = 256  # below this, starting worker processes costs more than it saves
+COPY_WORKERS = 8  # copies are I/O bound, keeping several in flight keeps the disk queue full
+PROPERTY_KEYS = ('copyright', 'version', 'link')
+_SRC_DETAILS_LAST = [None, None]  # (key, details) of the last cached_src_details() call, reset after each report
+RE_PROPERTIES = re.compile(rb'^#property\s(?P<key>copyright|version|link)\s*"(?P<val>.*?)"\s*$', re.MULTILINE)
+
+
+def _update_mmap(hasher, f) -> bool:
+    """Feed the whole file to the hasher in one call through a read-only memory map"""
+    try:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            hasher.update(mm)
+    except (OSError, ValueError):  # pipes, special files, etc. can't be mapped
+        return False
+    return True
 
 
-def hash_file(file: Path):
+def hash_file(file: str):
     with contextlib.suppress(PermissionError):
+        if HASH_ALGO == 'blake3':
+            return HASH_CLASS(max_threads=HASH_CLASS.AUTO).update_mmap(file).digest()
         hasher = HASH_CLASS()
-        with file.open('rb') as f:
-            while True:
-                data = f.read(BUFFER_SIZE)
-                if not data:
-                    break
-                hasher.update(data)
-        hashcode = hasher.hexdigest()
+        with open(file, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not (BUFFER_SIZE < size <= MMAP_MAX_SIZE and _update_mmap(hasher, f)):
+                while True:
+                    data = f.read(BUFFER_SIZE)
+                    if not data:
+                        break
+                    hasher.update(data)
+        hashcode = hasher.digest()  # raw bytes are half the size of hex and hash faster as dict keys
         return hashcode
     return None
 
 
-def last_index_of(iterable, item):
-    """Get the last index of item instead of first"""
-    index = -1
-    for i, thing in enumerate(iterable):
-        if thing == item:
-            index = i
-    return index
+def hash_files(files: typ.Iterable[str], workers=HASH_WORKERS) -> typ.Iterator[typ.Tuple[str, bytes]]:
+    """Hash files concurrently and yield (file, checksum) pairs in the same order as the input"""
+    files = list(files)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        yield from zip(files, executor.map(hash_file, files))
+
+
+def copy_to(src: str, dst: str, hardlink=False) -> str:
+    """Copy (or hard-link) src to dst, the parent directory of dst must already exist"""
+    if hardlink:
+        with contextlib.suppress(OSError):  # different drive, filesystem without hard links, etc.
+            os.link(os.path.abspath(src), os.path.abspath(dst))
+            return dst
+    return shutil.copy2(os.path.abspath(src), os.path.abspath(dst))
+
+
+def checksum_hex(checksum):
+    """Checksums are kept as raw digest bytes and only hex-encoded for output"""
+    return checksum.hex() if isinstance(checksum, bytes) else checksum
+
+
+def size_key(size: int, file: str) -> str:
+    """Placeholder checksum for a file that is the only one of its size and therefore was never hashed"""
+    return f'{SIZE_KEY_PREFIX}{size}:{file}'
+
+
+def is_size_key(checksum) -> bool:
+    return isinstance(checksum, str) and checksum.startswith(SIZE_KEY_PREFIX)
 
 
 def indent_line(text, spaces=4):
     return f"{' ' * spaces}{text}"
 
 
-def mql_src_details(file: Path, dump_file_text=False):
+def split_name(name: str) -> typ.Tuple[str, str]:
+    """(stem, suffix) of a file name, the same as Path.stem and Path.suffix without building a Path"""
+    dot = name.rfind('.')
+    if 0 < dot < len(name) - 1:
+        return name[:dot], name[dot:]
+    return name, ''
+
+
+def path_key(path: str) -> str:
+    """Case-folded path to look up target files with, NTFS and APFS treat names that only differ in case as one file"""
+    return os.path.normcase(path).lower()
+
+
+def mql_src_details(file: str, dump_file_text=False):
+    """#property details of a source file, the encoding comes from its header unless the whole text is dumped"""
+    suffix = split_name(os.path.basename(file))[1]
     try:
-        if file.suffix == '.mqproj':
-            data = json.loads(file.read_text())
-            return {k: data[k] for k in RE_PATTERNS.keys()}
-        if file.suffix not in MQL_SRC_FILES:
+        if suffix == '.mqproj':
+            with open(file) as f:
+                data = json.loads(f.read())
+            return {k: data[k] for k in PROPERTY_KEYS}
+        if suffix not in MQL_SRC_FILES:
             raise ValueError
-        text = file.read_bytes()
-        encoding = chardet.detect(text)['encoding'].lower()
-        text = (
-            text
-                .decode(encoding)
-                .encode('utf-8', 'ignore')
-                .decode('utf-8', 'ignore')
-                # .replace('\r\n', '\n')
-        )
-
-        def get(regex):
+        with open(file, 'rb') as f:
+            head = f.read(SNIFF_SIZE)
+            text = head + f.read() if dump_file_text else None
+        sample = head if text is None else text  # the whole text has to be ASCII if it is decoded as ASCII
+        if sample and sample.isascii():  # most MQL source is plain ASCII, no need for the detection heuristics
+            encoding = 'ascii'
+        else:
+            encoding = (detect_encoding(head)['encoding'] or 'utf-8').lower()
+        # the #property lines are ASCII, so they are matched on the raw bytes unless the encoding isn't ASCII based
+        props, props_encoding = head, encoding
+        if props.startswith(codecs.BOM_UTF8):  # otherwise ^#property can't match on the first line
+            props = props[len(codecs.BOM_UTF8):]
+        elif codecs.lookup(encoding).name.startswith(('utf-16', 'utf-32')):
+            props, props_encoding = head.decode(encoding, 'ignore').encode('utf-8'), 'utf-8'
+        res = dict.fromkeys(PROPERTY_KEYS)
+        for match in RE_PROPERTIES.finditer(props):
+            key = match.group('key').decode()
+            if res[key] is None:
+                res[key] = match.group('val').decode(props_encoding, 'ignore')
+                if None not in res.values():
+                    break
+        if text is not None:
             try:
-                return regex.search(text).group(1)
-            except Exception:
-                return None
-
-        res = {k: get(regex) for k, regex in RE_PATTERNS.items()}
+                decoded = text.decode(encoding)
+            except UnicodeDecodeError:  # the header didn't tell the whole story, so detect again on all of it
+                encoding = (detect_encoding(text)['encoding'] or 'utf-8').lower()
+                decoded = text.decode(encoding, 'replace')  # keep going, but leave a visible mark
+            text = (
+                decoded
+                    .encode('utf-8', 'ignore')
+                    .decode('utf-8', 'ignore')
+                    # .replace('\r\n', '\n')
+            )
     except Exception:
         encoding = None
         text = None
-        res = {k: None for k in RE_PATTERNS.keys()}
+        res = dict.fromkeys(PROPERTY_KEYS)
     res['encoding'] = encoding
-    if dump_file_text and file.suffix in MQL_SRC_FILES:
+    if dump_file_text and suffix in MQL_SRC_FILES:
         res['file_text'] = text
     return res
 
 
-def file_report_for_manifest(checksum: str, file_path: Path, dump_file_text=False):
-    stat = file_path.stat()
+def cached_src_details(checksum: bytes, file: str, dump_file_text=False):
+    """mql_src_details() memoized by checksum, since files with identical content have identical details
+
+    Only the last result is kept. report() sorts its jobs so identical files come one after another, which gives the
+    same hit rate without holding the details (and dumped text) of every file in each worker.
+    """
+    if checksum is None:  # the file couldn't be read when it was hashed
+        return mql_src_details(file, dump_file_text)
+    key = (checksum, split_name(os.path.basename(file))[1], dump_file_text)
+    if _SRC_DETAILS_LAST[0] != key:
+        _SRC_DETAILS_LAST[:] = key, mql_src_details(file, dump_file_text)
+    return _SRC_DETAILS_LAST[1]
+
+
+def _manifest_entry(args):
+    """Worker for MqlOrganizer.report(), args are passed as plain values to keep pickling cheap"""
+    checksum, path, stat, dump_file_text = args
+    return file_report_for_manifest(checksum, path, dump_file_text, stat)
+
+
+def dump_json(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2).encode('utf-8')
+
+
+def write_json(obj: dict, file: str, stream_key='manifest'):
+    """Write obj as indented JSON, serializing the items of obj[stream_key] one at a time
+
+    This way the document is never built as one big string, which matters for large manifests with file text.
+    """
+    def indented(data: bytes, level: int) -> bytes:
+        return data.replace(b'\n', b'\n' + b'  ' * level)  # raw newlines can't occur inside JSON strings
+
+    with open(file, 'wb') as f:
+        f.write(b'{')
+        for i, (key, value) in enumerate(obj.items()):
+            f.write(b',\n  ' if i else b'\n  ')
+            f.write(dump_json(key) + b': ')
+            if key != stream_key:
+                f.write(indented(dump_json(value), 1))
+                continue
+            f.write(b'[')
+            for j, item in enumerate(value):
+                f.write(b',\n    ' if j else b'\n    ')
+                f.write(indented(dump_json(item), 2))
+            f.write(b'\n  ]' if value else b']')
+        f.write(b'\n}\n')
+
+
+def file_report_for_manifest(checksum: bytes, file_path: str, dump_file_text=False, stat: os.stat_result = None):
+    stat = stat or os.stat(file_path)
+    name = os.path.basename(file_path)
+    suffix = split_name(name)[1]
     d = {
-        'name'         : file_path.name,
-        'extension'    : file_path.suffix,
-        'is_src'       : bool(file_path.suffix in MQL_SRC_FILES),
+        'name'         : name,
+        'extension'    : suffix,
+        'is_src'       : bool(suffix in MQL_SRC_FILES),
         'file_size'    : stat.st_size,
         'time_modified': str(dt.datetime.fromtimestamp(stat.st_mtime)),
     }
-    d.update(mql_src_details(file_path, dump_file_text))
+    d.update(cached_src_details(checksum, file_path, dump_file_text))
     d.update({
-        'path'    : str(file_path.absolute()),
-        'checksum': checksum,
+        'path'    : os.path.abspath(file_path),
+        'checksum': checksum_hex(checksum),
     })
     return d
 
 
 class MqlOrganizer:
 
-    def __init__(self, search_path, save_path, compiled_files=False, **kwargs):
-        self.save_path = Path(save_path)
-        self.save_path.mkdir(parents=True, exist_ok=True)
-        self.search_path = Path(search_path)
-        self.report_file_json = self.save_path / 'FILE_REPORT.json'
-        self.glob_pattern = '**/*.*'
+    def __init__(self, search_path, save_path, compiled_files=False, use_hardlinks=False, **kwargs):
+        # paths are plain strings from here on, os.path is much cheaper than building Path objects per file
+        self.save_path = os.path.normpath(save_path)
+        os.makedirs(self.save_path, exist_ok=True)
+        self.search_path = os.path.normpath(search_path)
+        self.report_file_json = os.path.join(self.save_path, 'FILE_REPORT.json')
         self.mql_path_parts = {'MQL4', 'MQL5'}
+        self.use_hardlinks = use_hardlinks
         self.loose_extensions = MQL_SRC_FILES.copy()
         if compiled_files:
             self.loose_extensions.update({'.ex4', '.ex5'})
@@ -181,109 +337,253 @@ class MqlOrganizer:
             '.dll', '.mqproj', '.py', '.cl', '.tpl', '.html', '.set', '.wav',
             '.chr', '.wnd', '.bin', '.ini', '.bmp', '.png', '.txt', '.csv'
         }
-        self.unorganized_dir = self.save_path / kwargs.get('unorganized_dirname', 'UNORGANIZED')
-        self.manifest = set()
+        self.unorganized_dir = os.path.join(self.save_path, kwargs.get('unorganized_dirname', 'UNORGANIZED'))
         self.files_by_checksum = defaultdict(lambda: defaultdict(set))
-        self.res_checksum_map = defaultdict(set)
+        self.res_checksum_map = defaultdict(set)  # the manifest: checksum -> organized paths
+        self.res_checksums = {}  # path_key(path) -> checksum, the reverse of res_checksum_map
+        self.planned_copies = {}  # path_key(new_path) -> (new_path, file, checksum) waiting for copy_files()
+        self.size_index = defaultdict(list)
+        self.stats = {}  # stat results collected while walking, so no file gets stat'ed twice
+        self.new_dirs = {}  # file -> new_dir from walk(), see get_new_path()
+        self.res_size_index = defaultdict(list)
         self.diff_files = set()
         self.git_paths = set()
-        self.file_count = len(self.manifest)
+        self.file_count = 0
+
+    def walk(self, is_git=True, root: str = None) -> typ.Iterator[typ.Tuple[os.DirEntry, bool, bool, str]]:
+        """Yield (entry, is_mql_path, is_git_path, new_dir) for every file below root, depth-first like Path.glob
+
+        Entries carry the stat data returned with the directory listing (free on Windows), so use entry.stat().
+        new_dir is where get_new_path() puts the file, or None if it goes to the unorganized dir. All of it is
+        tracked per directory while descending, so nothing is recomputed from the parts of each file.
+        """
+        root = self.search_path if root is None else root
+        root_parts = set(os.path.normpath(root).split(os.sep))
+        if '$Recycle.Bin' in root_parts:
+            return
+        is_organized, new_path = self.get_new_path(os.path.join(root, '_'))
+        stack = [(
+            root,
+            frozenset(root_parts & self.mql_path_parts),
+            '.git' in root_parts,
+            os.path.dirname(new_path) if is_organized else None,
+        )]
+        while stack:
+            path, mql_dirs, is_git_path, new_dir = stack.pop()
+            is_mql_path = bool(mql_dirs)
+            subdirs = []
+            try:
+                with os.scandir(path) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            for entry in entries:
+                name = entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if name == '$Recycle.Bin' or (name == '.git' and not is_git):
+                            continue
+                        if name in self.mql_path_parts:
+                            # organized paths start at the last MQL dir, but only when all MQL dirs are alike
+                            sub_mql_dirs = mql_dirs | {name}
+                            sub_new_dir = os.path.join(self.save_path, name) if len(sub_mql_dirs) == 1 else None
+                        else:
+                            sub_mql_dirs = mql_dirs
+                            sub_new_dir = None if new_dir is None else os.path.join(new_dir, name)
+                        subdirs.append((entry.path, sub_mql_dirs, is_git_path or name == '.git', sub_new_dir))
+                    elif entry.is_file():
+                        yield entry, is_mql_path, is_git_path, new_dir
+                except OSError:
+                    continue
+            stack.extend(reversed(subdirs))
+
+    def iter_candidates(self, is_git=True) -> typ.Iterator[typ.Tuple[str, bool, os.stat_result, str]]:
+        """Yield (file, is_mql_path, stat, new_dir) for every file in the search path that should be organized"""
+        # loose files are gathered from anywhere, bound files (and git repos) only from inside MQL dirs
+        loose_extensions = frozenset(self.loose_extensions)
+        all_extensions = frozenset(self.loose_extensions | self.bound_extensions)
+        for entry, is_mql_path, is_git_path, new_dir in self.walk(is_git):
+            name = entry.name
+            if '.' not in name:  # same as the previous '**/*.*' glob
+                continue
+            ext = split_name(name)[1]
+            if ext in all_extensions:
+                if not is_mql_path and ext not in loose_extensions:
+                    continue
+            elif not (is_mql_path and is_git and is_git_path):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            yield entry.path, is_mql_path, stat, new_dir
 
     def gather_files(self, verbose=False, is_git=True):
-        loose_extensions = self.loose_extensions
-        bound_extensions = self.bound_extensions
-        counter = 0
-        for file in self.search_path.glob(self.glob_pattern):
-            path_parts_set = set(file.parts)
-            if '$Recycle.Bin' in path_parts_set:
-                continue
-            is_mql_path = bool(path_parts_set & self.mql_path_parts)
-            ext = file.suffix
-            if ((ext in loose_extensions) or
-                    (is_mql_path and (ext in bound_extensions or (is_git and '.git' in path_parts_set)))
-            ):
-                checksum = hash_file(file)
-                self.files_by_checksum[checksum][is_mql_path].add(file)
-                counter += 1
-                if verbose and file is not None:
-                    print(f"[{counter:05}] {file.name}\n({HASH_ALGO})CHECKSUM = {checksum}")
+        gathered = []
+        for file, is_mql_path, stat, new_dir in self.iter_candidates(is_git):
+            self.stats[file] = stat
+            self.new_dirs[file] = new_dir
+            entry = (file, is_mql_path, stat.st_size, stat.st_mtime)
+            self.size_index[stat.st_size].append(entry)
+            gathered.append(entry)
+        # files of different sizes can't share a checksum, so only hash a file if another one has its size
+        to_hash = [
+            file for file, _, size, _ in gathered
+            if len(self.size_index[size]) > 1 or size in self.res_size_index
+        ]
+        checksums = dict(hash_files(to_hash))
+        # results are consumed here on the main thread so files_by_checksum only has a single writer
+        for counter, (file, is_mql_path, size, _) in enumerate(gathered, 1):
+            checksum = checksums[file] if file in checksums else size_key(size, file)
+            self.files_by_checksum[checksum][is_mql_path].add(file)
+            if verbose and file is not None:
+                shown = checksum_hex(checksum) if file in checksums else 'UNIQUE SIZE (not hashed)'
+                print(f"[{counter:05}] {os.path.basename(file)}\n({HASH_ALGO})CHECKSUM = {shown}")
         return self.files_by_checksum
 
-    def get_new_path(self, file: Path) -> typ.Tuple[bool, Path]:
-        parts = set(file.parts)
-        mql_path_part = parts & self.mql_path_parts
+    def get_new_path(self, file: str) -> typ.Tuple[bool, str]:
+        name = os.path.basename(file)
+        if file in self.new_dirs:
+            new_dir = self.new_dirs[file]
+            if new_dir is not None:
+                return (True, os.path.join(new_dir, name))
+            return (False, os.path.join(self.unorganized_dir, name))
+        parts = os.path.normpath(file).split(os.sep)
+        mql_path_part = set(parts) & self.mql_path_parts
         if len(mql_path_part) == 1:
             mql_dir = mql_path_part.pop()
-            with contextlib.suppress(ValueError):
-                index = last_index_of(file.parts, mql_dir)
-                path_str = '/'.join(file.parts[index:])
-                path = self.save_path / path_str
-                return (True, path)
-        return (False, self.unorganized_dir / file.name)
-
-    def copy_file(self, file: Path, checksum: str) -> typ.Tuple[bool, Path]:
+            index = len(parts) - 1 - parts[::-1].index(mql_dir)  # the organized path starts at the last MQL dir
+            return (True, os.path.join(self.save_path, *parts[index:]))
+        return (False, os.path.join(self.unorganized_dir, name))
+
+    def plan_copy(self, file: str, checksum: Checksum) -> typ.Tuple[bool, str]:
+        """Resolve the new path of file and queue it for copy_files() unless an identical file is already there"""
         is_organized, new_path = self.get_new_path(file)
         new_checksum = checksum
-        old_path = file
         counter = itertools.count(1)
         while True:
-            if new_path.exists() and ((checksum, new_path,) in self.manifest):
-                return (False, new_path,)
-            elif new_path.exists():
-                old_checksum = hash_file(new_path)
-                if new_checksum == old_checksum:
+            key = path_key(new_path)
+            planned = self.planned_copies.get(key)
+            if planned is not None:
+                if planned[2] == new_checksum:  # an identical file is already headed to this path
                     return (False, new_path,)
-                new_file_name = f'{file.stem}({next(counter)}){file.suffix}'
-                new_path = new_path.parent / new_file_name
-                self.diff_files.add(new_path)
-            else:
-                new_path.parent.mkdir(parents=True, exist_ok=True)
-                if shutil.copy2(str(old_path.absolute()), str(new_path.absolute())):
+            elif key in self.res_checksums:
+                # already in the manifest, so its checksum is known (or its size is unique) and it isn't hashed again
+                if self.res_checksums[key] == new_checksum:
+                    return (False, new_path,)
+            elif not os.path.exists(new_path):
+                self.planned_copies[key] = (new_path, file, checksum)
+                return (True, new_path,)
+            # a file that isn't in the manifest is only hashed when its size says it could be the same file
+            elif self._stat(new_path).st_size == self._stat(file).st_size and hash_file(new_path) == new_checksum:
+                return (False, new_path,)
+            stem, suffix = split_name(os.path.basename(file))
+            new_path = os.path.join(os.path.dirname(new_path), f'{stem}({next(counter)}){suffix}')
+            self.diff_files.add(new_path)
+
+    def copy_files(self, verbose=False):
+        """Copy all planned files concurrently, the manifest is only updated here on the main thread"""
+        planned, self.planned_copies = self.planned_copies.values(), {}
+        # create each target directory once, shallowest first, instead of once per copied file
+        for directory in sorted({os.path.dirname(new_path) for new_path, *_ in planned}, key=lambda d: d.count(os.sep)):
+            with contextlib.suppress(PermissionError):
+                os.makedirs(directory, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=COPY_WORKERS) as executor:
+            futures = {
+                executor.submit(copy_to, old_path, new_path, self.use_hardlinks): (old_path, new_path, checksum)
+                for new_path, old_path, checksum in planned
+            }
+            for future in as_completed(futures):
+                old_path, new_path, checksum = futures[future]
+                with contextlib.suppress(PermissionError, FileNotFoundError):  # FileNotFoundError: no target dir
+                    future.result()
+                    if old_path in self.stats:  # copy2 keeps the size and mtime, which is all the report uses
+                        self.stats[new_path] = self.stats[old_path]
                     self._gitcheck(new_path)
-                    self.manifest.add((checksum, new_path,))
-                    self.res_checksum_map[checksum].add(new_path)
+                    self._add_to_manifest(checksum, new_path)
                     self.file_count += 1
-                return (True, new_path,)
+                    if verbose:
+                        print('', new_path)
 
     def run(self, verbose=False):
         if verbose:
             print('Scanning existing files...')
-        for fp in self.save_path.glob('**/*.*'):
+        for entry, *_ in self.walk(root=self.save_path):
+            if '.' not in entry.name or entry.name.endswith('.json'):
+                continue
+            fp = entry.path
             self._gitcheck(fp)
-            if fp.is_file() and fp.suffix != '.json':
-                checksum = hash_file(fp)
-                self.manifest.add((checksum, fp,))
-                self.res_checksum_map[checksum].add(fp)
+            with contextlib.suppress(OSError):
+                self.stats[fp] = entry.stat()
+                self.res_size_index[self.stats[fp].st_size].append(fp)
         files = self.gather_files(verbose)
+        # existing files only need a checksum if a gathered file of the same size could be a duplicate
+        existing = []
+        for size, fps in self.res_size_index.items():
+            if size in self.size_index:
+                existing.extend(fps)
+                continue
+            for fp in fps:
+                self._add_to_manifest(size_key(size, fp), fp)
+        for fp, checksum in hash_files(existing):
+            self._add_to_manifest(checksum, fp)
         for hash, d in files.items():
             paths = d[True] or d[False]  # don't copy unorganized file if an organized one exists with same checksum!
             for path in paths:
                 with contextlib.suppress(PermissionError):
-                    is_copy, new_path = self.copy_file(path, hash)
-                    if verbose and new_path is not None:
-                        print('' if is_copy else 'Skipping...', new_path)
+                    is_copy, new_path = self.plan_copy(path, hash)
+                    if verbose and not is_copy:
+                        print('Skipping...', new_path)
+        self.copy_files(verbose)
 
     def report(self, dump_file_text=False):
         print('Generating report...')
-        mr = file_report_for_manifest
+        entries = [(c, p) for c, paths in self.res_checksum_map.items() for p in paths]
+        # files that were the only one of their size were never hashed during the run. They are hashed here and
+        # not in the workers: a forked worker hangs in blake3's thread pool once the parent has started it
+        hashed = dict(hash_files(p for c, p in entries if is_size_key(c)))
+        jobs = [(hashed[p] if is_size_key(c) else c, p, self.stats.get(p), dump_file_text) for c, p in entries]
+        # identical files end up next to each other in the same chunk and share cached details
+        jobs.sort(key=lambda job: (str(job[0]), split_name(os.path.basename(job[1]))[1]))
+        if len(jobs) < REPORT_POOL_MIN_FILES:
+            manifest = list(map(_manifest_entry, jobs))
+        else:
+            # encoding detection and parsing are CPU bound, and each entry only reads its own file. Workers are
+            # spawned, not forked: forking a process with live hash and copy threads can deadlock the children
+            chunksize = max(1, len(jobs) // (REPORT_WORKERS * 4))
+            mp_context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=REPORT_WORKERS, mp_context=mp_context) as executor:
+                manifest = list(executor.map(_manifest_entry, jobs, chunksize=chunksize))
+        _SRC_DETAILS_LAST[:] = None, None
         report_dict = {
             'time_completed': str(dt.datetime.now()),
-            'total_files'   : len(self.manifest),
+            'total_files'   : len(jobs),
             'checksum_algo' : HASH_ALGO,
-            'search_path'   : str(self.search_path.absolute()),
-            'save_path'     : str(self.save_path.absolute()),
+            'search_path'   : os.path.abspath(self.search_path),
+            'save_path'     : os.path.abspath(self.save_path),
             'extensions'    : sorted(self.loose_extensions ^ self.bound_extensions),
-            'git_paths'     : sorted(map(str, self.git_paths)),
-            'diff_files'    : sorted(map(str, self.diff_files)),
-            'manifest'      : [mr(c, p, dump_file_text) for c, p in self.manifest],
+            'git_paths'     : sorted(self.git_paths),
+            'diff_files'    : sorted(self.diff_files),
+            'manifest'      : manifest,
         }
-        self.report_file_json.write_text(json.dumps(report_dict, indent=4))
+        write_json(report_dict, self.report_file_json)
         print('JSON report ready @', self.report_file_json)
         return report_dict
 
-    def _gitcheck(self, fp: Path):
-        if '.git' in fp.parts:
-            git_path = Path(*fp.parts[:fp.parts.index('.git') + 1])
+    def _add_to_manifest(self, checksum: Checksum, fp: str):
+        self.res_checksum_map[checksum].add(fp)
+        self.res_checksums[path_key(fp)] = checksum
+
+    def _stat(self, fp: str) -> os.stat_result:
+        stat = self.stats.get(fp)
+        if stat is None:
+            stat = self.stats[fp] = os.stat(fp)
+        return stat
+
+    def _gitcheck(self, fp: str):
+        parts = fp.split(os.sep)
+        if '.git' in parts:
+            git_path = os.sep.join(parts[:parts.index('.git') + 1])
             self.git_paths.add(git_path)
 
 
@@ -316,6 +616,11 @@ def main():
         default='n',
         feedback=lambda res: f'Gathering compiled files: {res}'
     )
+    is_hardlinks = _input(
+        msg='Hard-link files instead of copying them when possible? (Y/n)',
+        default='n',
+        feedback=lambda res: f'Hard-linking files: {res}'
+    )
     is_excel_report = _input(
         msg='Would you like to generate an Excel report? (Y/n)',
         default='n',
@@ -327,13 +632,21 @@ def main():
         feedback=lambda res: f'Dump source-code: {res}'
     )
     input('Press ENTER to begin > ')
-    program = MqlOrganizer(search_path, save_path, compiled_files=is_compiled)
+    program = MqlOrganizer(search_path, save_path, compiled_files=is_compiled, use_hardlinks=is_hardlinks)
     program.run(verbose=True)
     report = program.report(dump_file_text=is_text_dump)
     if is_excel_report:
-        excel_path = program.save_path / 'FILE_REPORT.xlsx'
-        df = pd.DataFrame(report['manifest']).drop(['file_text'], axis=1)  # noqa
-        df.to_excel(excel_path, index=False)
+        import xlsxwriter  # only needed here, keeping it out of module scope lets report workers start quickly
+        excel_path = os.path.join(program.save_path, 'FILE_REPORT.xlsx')
+        manifest = report['manifest']
+        columns = [k for k in dict.fromkeys(k for entry in manifest for k in entry) if k != 'file_text']
+        # constant_memory streams each row to disk instead of holding the whole workbook in memory, but it also
+        # drops writes to earlier rows, so the sheet is written row by row in order
+        with xlsxwriter.Workbook(excel_path, {'constant_memory': True, 'strings_to_urls': False}) as book:
+            sheet = book.add_worksheet('Manifest')
+            sheet.write_row(0, 0, columns, book.add_format({'bold': True}))
+            for row, entry in enumerate(manifest, 1):
+                sheet.write_row(row, 0, [entry.get(k) for k in columns])
         print(f'Excel report ready @ {excel_path}')
 
 